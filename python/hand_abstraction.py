@@ -78,7 +78,7 @@ def archetypal_flop_hands():
         for preflop, flop in product(combinations(deck, 2), combinations(deck, 3)):
             hand = preflop + flop
             if unique_cards(hand):
-                hand = archetypal_hand(hand)
+                hand = compute_archetypal_hand(hand)
                 if hand not in used_hands:
                     used_hands[hand] = True
             t.update()
@@ -100,7 +100,7 @@ def archetypal_turn_hands():
         for preflop, flop, turn in product(combinations(deck, 2), combinations(deck, 3), deck):
             hand = preflop + flop + (turn,)
             if unique_cards(hand):
-                hand = archetypal_hand(hand)
+                hand = compute_archetypal_hand(hand)
                 if hand not in used_hands:
                     used_hands[hand] = True
             t.update()
@@ -229,18 +229,14 @@ def equity(hand, samples=1000):
     hand = list(hand)
     preflop = hand[:2]
     board = hand[2:7]
-    deck = get_deck()
-    for card in preflop + board:
-        deck.remove(card)
-    wins = 0
-    for i in range(samples):
-        opp_hand = list(np.random.choice(deck, 2, replace=False))
-        my_hand = HAND_TABLE[preflop + board]
-        opp_hand = HAND_TABLE[opp_hand + board]
-        if my_hand > opp_hand:
-            wins += 1
-        elif my_hand == opp_hand:
-            wins += 0.5
+    deck = np.delete(DECK_IDS, [CARD_IDS[card] for card in hand])
+    board_ids = np.array([CARD_IDS[card] for card in board], dtype=np.uint8)
+
+    # Deal and evaluate every sampled opponent hand in one batch
+    opp_hands = np.hstack([deal_batch(deck, samples, 2), np.tile(board_ids, (samples, 1))])
+    opp_strengths = HAND_TABLE.strengths(opp_hands)
+    my_strength = HAND_TABLE[preflop + board]
+    wins = np.sum(my_strength > opp_strengths) + 0.5 * np.sum(my_strength == opp_strengths)
     equity = wins / samples
     return equity
 
@@ -433,21 +429,20 @@ class TurnAbstraction(CardAbstraction):
         self.samples = samples
 
     def __getitem__(self, cards):
-        preflop = cards[:2]
-        board = cards[2:]
-        deck = get_deck()
-        for card in cards:
-            deck.remove(card)
-
-        n_wins = 0
-        for i in range(self.samples):
-            opp_hand1, opp_hand2, river = np.random.choice(deck, 3, replace=False)
-            opp_hand = HAND_TABLE[[opp_hand1, opp_hand2] + board + [river]]
-            my_hand = HAND_TABLE[preflop + board + [river]]
-            if my_hand > opp_hand:
-                n_wins += 1
-            elif my_hand == opp_hand:
-                n_wins += 0.5
+        cards = list(cards)
+        hand_ids = np.array([CARD_IDS[card] for card in cards], dtype=np.uint8)
+        deck = np.delete(DECK_IDS, hand_ids)
+        board_ids = hand_ids[2:]
+
+        # Each sample deals two opponent hole cards and a river card, and all
+        # samples are evaluated in one batch.
+        dealt = deal_batch(deck, self.samples, 3)
+        rivers = dealt[:, 2:]
+        opp_hands = np.hstack([dealt, np.tile(board_ids, (self.samples, 1))])
+        my_hands = np.hstack([np.tile(hand_ids, (self.samples, 1)), rivers])
+        opp_strengths = HAND_TABLE.strengths(opp_hands)
+        my_strengths = HAND_TABLE.strengths(my_hands)
+        n_wins = np.sum(my_strengths > opp_strengths) + 0.5 * np.sum(my_strengths == opp_strengths)
 
         bucket = int(n_wins / self.samples * self.buckets)
         return bucket
@@ -1,21 +1,83 @@
 import os
+import math
 import itertools
 from tqdm import tqdm
-import pickle
+import numpy as np
+from numba import njit
 from texas_utils import *
-from texas_hands import TexasHand
+from texas_hands import classify_ids
 import pdb
 
-TABLE_NAME = 'hand_table.pkl'
+TABLE_NAME = 'hand_ranks.bin'
+N_HANDS = math.comb(52, 5)
+
+# BINOMIAL[n][k] = n choose k, used for the combinatorial number system
+BINOMIAL = [[math.comb(n, k) for k in range(6)] for n in range(52)]
+BINOMIAL_ARRAY = np.array(BINOMIAL, dtype=np.int64)
+
+
+def hand_index(ids):
+    """Returns a unique index in [0, C(52, 5)) for the given five card ids.
+
+    This is the combinatorial number system, which acts as a perfect hash from
+    unordered 5-card hands to a dense range of integers.
+
+    Inputs:
+        ids - Five distinct packed card ids (see texas_utils.card_id)
+    """
+    c0, c1, c2, c3, c4 = sorted(ids)
+    return (BINOMIAL[c0][1] + BINOMIAL[c1][2] + BINOMIAL[c2][3] + BINOMIAL[c3][4]
+            + BINOMIAL[c4][5])
+
+
+@njit(cache=True)
+def best_strength(table, ids):
+    """Returns the strength of the best 5-card hand out of 5-7 card ids.
+
+    Compiled with numba since this is the innermost loop of every showdown.
+
+    Inputs:
+        table - Hand strength table indexed by hand_index
+        ids - np.uint8 array of 5 to 7 distinct packed card ids
+    """
+    ids = np.sort(ids)
+    n = ids.shape[0]
+    best = -1
+    # Walk the 5-card subsets in order so each one stays sorted
+    for a in range(n - 4):
+        for b in range(a + 1, n - 3):
+            for c in range(b + 1, n - 2):
+                for d in range(c + 1, n - 1):
+                    for e in range(d + 1, n):
+                        index = (BINOMIAL_ARRAY[ids[a], 1] + BINOMIAL_ARRAY[ids[b], 2]
+                                 + BINOMIAL_ARRAY[ids[c], 3] + BINOMIAL_ARRAY[ids[d], 4]
+                                 + BINOMIAL_ARRAY[ids[e], 5])
+                        strength = table[index]
+                        if strength > best:
+                            best = strength
+    return best
+
+
+# Deliberately not parallel=True: numba's default threading layer isn't fork
+# safe, and the pools forked after a batch lookup would hang at exit. The
+# batches are small (20 to 1000 hands) anyway.
+@njit(cache=True)
+def best_strengths(table, hands):
+    """Batched best_strength over the rows of an (N, 5-7) np.uint8 array."""
+    result = np.empty(hands.shape[0], dtype=np.int16)
+    for i in range(hands.shape[0]):
+        result[i] = best_strength(table, hands[i])
+    return result
+
 
 class HandTable:
 
     def __init__(self):
-        if os.path.isfile(TABLE_NAME):
-            self.table = pickle.load(open(TABLE_NAME, 'rb'))
-        else:
-            self.table = self.make_table()
-            pickle.dump(self.table, open(TABLE_NAME, 'wb'), protocol=pickle.HIGHEST_PROTOCOL)
+        if not os.path.isfile(TABLE_NAME):
+            self.make_table().tofile(TABLE_NAME)
+        # Memory map the raw table so loading is instant and every process
+        # using it shares the same physical pages.
+        self.table = np.memmap(TABLE_NAME, dtype=np.int16, mode='r', shape=(N_HANDS,))
 
     def __getitem__(self, cards):
         if not 5 <= len(cards) <= 7:
@@ -23,29 +85,40 @@ class HandTable:
 
         # Since the table holds 5 card hands, find the best possible 5 card hand
         # out of the list of 5-7 cards.
-        best_strength = max([self.table[isomorphic_hand(hand)] for hand in itertools.combinations(cards, 5)])
-        return best_strength
+        ids = np.array([CARD_IDS[card] for card in cards], dtype=np.uint8)
+        return int(best_strength(self.table, ids))
+
+    def strengths(self, hands):
+        """Returns the strength of each hand in a batch of same-sized hands.
+
+        Inputs:
+            hands - (N, 5-7) np.uint8 array of packed card ids, or a list of
+                hands in the standard 'Ad' string format.
+
+        Returns:
+            strengths - np.int16 array of length N
+        """
+        if not isinstance(hands, np.ndarray):
+            hands = np.array([[CARD_IDS[card] for card in hand] for hand in hands], dtype=np.uint8)
+        if hands.ndim != 2 or not 5 <= hands.shape[1] <= 7:
+            raise ValueError('Wrong number of cards.')
+        return best_strengths(self.table, hands)
 
-    # TODO: This unintentionally makes there be too many integers since hands is
-    # a list. len(self.table) = 160537 but some hands are in the millions. Not
-    # sure if this is an issue or not.
     def make_table(self):
-        hands = []
+        """Ranks every 5-card hand, indexed by hand_index.
+
+        Returns:
+            table - np.int16 array of length C(52, 5). Higher values are better
+                hands, and hands that tie share the same value.
+        """
         print('Constructing the lookup table for hand evaluation...')
-        for cards in itertools.combinations(get_deck(), 5):
-            hand = TexasHand(isomorphic_hand(cards))
-            hands.append(hand)
-
-        table = {}
-        hands = sorted(hands)
-        for i, hand in enumerate(hands):
-            table[tuple(hand.cards)] = i
-        # Hands that are equal need to be assigned the same integer.
-        # TODO: Bug here with 1 starting at 0 (I think)
-        for i, hand in enumerate(hands[1:]):
-            prev_hand = hands[i-1]
-            if hand == prev_hand:
-                table[tuple(hand.cards)] = table[tuple(prev_hand.cards)]
+        # Only the integer ordering key of each hand is kept, rather than a
+        # TexasHand per hand, so building the table fits in a few dozen MB.
+        keys = np.empty(N_HANDS, dtype=np.int64)
+        for ids in tqdm(itertools.combinations(range(52), 5), total=N_HANDS):
+            keys[hand_index(ids)] = classify_ids(ids)[1]
+        # Rank the keys so that hands that tie get the same strength
+        _, table = np.unique(keys, return_inverse=True)
+        table = table.astype(np.int16)
         print('Done.')
         return table
-
@@ -1,12 +1,19 @@
-import pickle
+import itertools
 import json
+import numpy as np
+from texas_utils import ID_CARDS, ISOMORPHIC_SUITS, RANK, isomorphic_hands, suit_of
+from hand_table import HandTable
 
-table = pickle.load(open('hand_table.pkl', 'rb'))
-json_table = {}
-for tuple_key in table:
-    string_key = ''.join(tuple_key)
-    json_table[string_key] = table[tuple_key]
+table = HandTable()
+# Canonicalize every 5-card hand in one batch and keep the distinct ones
+hands = np.array(list(itertools.combinations(range(52), 5)), dtype=np.uint8)
+hands = np.unique(isomorphic_hands(hands), axis=0)
+strengths = table.strengths(hands)
 
-breakpoint()
+json_table = {}
+for hand, strength in zip(hands, strengths):
+    # Same key format as isomorphic_hand: the sorted card strings joined together
+    string_key = ''.join(sorted([ID_CARDS[c][RANK] + ISOMORPHIC_SUITS[suit_of(c)] for c in hand]))
+    json_table[string_key] = int(strength)
 
 json.dump(json_table, open('hand_table.json', 'w'))
@@ -0,0 +1,6 @@
+# Builds the optional compiled kernels in _hotkernels.pyx:
+#     python setup.py build_ext --inplace
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(ext_modules=cythonize('_hotkernels.pyx'))
@@ -4,7 +4,6 @@ import os
 import itertools
 from itertools import product, permutations, combinations
 import math
-import functools
 import pickle
 import pdb
 import numpy as np
@@ -12,7 +11,48 @@ from tqdm import tqdm
 from texas_utils import *
 
 
-@functools.total_ordering
+def classify_ids(ids):
+    """Returns the hand type and ordering key of five packed card ids.
+
+    The type is found by building the hand's signature in one pass (flush,
+    straight, and how many pairs of cards share a rank) and looking it up in
+    HAND_TYPES instead of trying each hand type in turn.
+
+    The key packs the hand type and ranks into one integer that orders hands.
+    The type goes in the top bits, followed by the five ranks, 4 bits each,
+    ordered by how often they appear and then by rank. For example, the full
+    house 99922 packs as (FULL_HOUSE, 9, 9, 9, 2, 2) and the two pair KK55A
+    packs as (TWO_PAIR, 13, 13, 5, 5, 14). Comparing two keys is then the same
+    as comparing the hands.
+    """
+    first = ids[0]
+    flush = True
+    rank_mask = 0
+    counts = {}
+    pairs = 0
+    for c in ids:
+        if (c ^ first) & 3:
+            flush = False
+        r = (c >> 2) + 2
+        rank_mask |= 1 << (c >> 2)
+        n = counts.get(r, 0)
+        pairs += n
+        counts[r] = n + 1
+    straight = rank_mask in STRAIGHT_MASKS
+    hand_type = HAND_TYPES[flush << 4 | straight << 3 | pairs]
+    if hand_type == STRAIGHT_FLUSH and rank_mask == ROYAL_MASK:
+        hand_type = ROYAL_FLUSH
+
+    if straight and rank_mask == WHEEL_MASK:
+        ordered = (5, 4, 3, 2, 1)    # The ace plays low in the wheel
+    else:
+        ordered = sorted([(c >> 2) + 2 for c in ids], key=lambda r: (counts[r], r), reverse=True)
+    key = hand_type
+    for r in ordered:
+        key = key << 4 | r
+    return hand_type, key
+
+
 class TexasHand:
     """Represents a standard 5-card Texas Hold'em hand."""
 
@@ -29,8 +69,13 @@ class TexasHand:
         """
         self.check_input(cards)
         self.cards = list(cards)
-        self.ranks = sorted([RANKS[card[0]] for card in self.cards])
-        self.suits = [card[1] for card in self.cards]
+        # Cards packed as integers so classification is just bit twiddling
+        self.ids = [CARD_IDS[card] for card in self.cards]
+        self.ranks = sorted([rank_of(c) for c in self.ids])
+        self.suits = [SUITS[suit_of(c)] for c in self.ids]
+        self.rank_mask = 0
+        for c in self.ids:
+            self.rank_mask |= 1 << (c >> 2)
         # How many times each rank appears in the hand (useful for hand classification)
         _, self.counts = np.sort(np.unique(self.ranks, return_counts=True))
         self.playable_cards = None
@@ -43,7 +88,7 @@ class TexasHand:
         for card in cards:
             if not isinstance(card, str):
                 raise TypeError('Cards must be strings in the format "5d"')
-            if len(card) != 2 or card[0] not in RANKS or card[1] not in SUITS:
+            if card not in CARD_IDS:
                 raise ValueError('Invalid card string: ' + card)
         # Test for duplicate cards
         _, counts = np.unique(cards, return_counts=True)
@@ -53,39 +98,22 @@ class TexasHand:
     def classify(self):
         """Identifies which type of poker hand this is."""
         if len(self.cards) > 5:
-            best_subhand = None
-            for five_cards in itertools.combinations(self.cards, 5):
-                hand = TexasHand(five_cards)
-                if hand > best_subhand:
-                    best_subhand = hand
-                    self.playable_cards = five_cards
-            self.type = best_subhand.type
+            # Score each 5-card subset straight from the packed ids rather than
+            # building a whole TexasHand for every one of them.
+            best = None
+            for subset in itertools.combinations(range(len(self.ids)), 5):
+                hand_type, key = classify_ids([self.ids[i] for i in subset])
+                if best is None or key > best[1]:
+                    best = hand_type, key, subset
+            self.type, self.key, subset = best
+            self.playable_cards = tuple(self.cards[i] for i in subset)
         else:
             self.playable_cards = self.cards
-            if self.is_royal_flush():
-                self.type = ROYAL_FLUSH
-            elif self.is_straight_flush():
-                self.type = STRAIGHT_FLUSH
-            elif self.is_four_of_a_kind():
-                self.type = FOUR_OF_A_KIND
-            elif self.is_full_house():
-                self.type = FULL_HOUSE
-            elif self.is_flush():
-                self.type = FLUSH
-            elif self.is_straight():
-                self.type = STRAIGHT
-            elif self.is_three_of_a_kind():
-                self.type = THREE_OF_A_KIND
-            elif self.is_two_pair():
-                self.type = TWO_PAIR
-            elif self.is_pair():
-                self.type = PAIR
-            else:
-                self.type = HIGH_CARD
+            self.type, self.key = classify_ids(self.ids)
 
     def is_royal_flush(self):
-        # Ace-high straight flush = royal flush
-        return self.is_straight_flush() and RANKS['A'] in self.ranks
+        # Ace-high straight flush = royal flush (the A2345 wheel is ace-low)
+        return self.is_straight_flush() and self.rank_mask == ROYAL_MASK
 
     def is_straight_flush(self):
         return self.is_straight() and self.is_flush()
@@ -104,16 +132,17 @@ class TexasHand:
         return np.array_equal(self.counts, np.array([2, 3]))
 
     def is_flush(self):
-        suit = self.cards[0][1]
-        for card in self.cards:
-            if card[1] != suit:
+        # The suit lives in the low two bits, so XOR with the first card is
+        # zero in those bits exactly when the suits match.
+        first = self.ids[0]
+        for c in self.ids:
+            if (c ^ first) & 3:
                 return False
         return True
 
     def is_straight(self):
-        # True if the ranks are the same as the range (a straight)
-        return (self.ranks == list(range(self.ranks[0], self.ranks[-1] + 1))
-                or self.ranks == [2, 3, 4, 5, 14])    # Ace low straight
+        # Five distinct consecutive ranks set exactly the bits of one straight
+        return self.rank_mask in STRAIGHT_MASKS
 
     def is_three_of_a_kind(self):
         return self.is_n_of_a_kind(3)
@@ -125,20 +154,38 @@ class TexasHand:
     def is_pair(self):
         return self.is_n_of_a_kind(2)
 
+    # All six comparisons are spelled out rather than using
+    # functools.total_ordering, whose generated methods call both __lt__ and
+    # __eq__. Any hand beats no hand (None).
     def __lt__(self, other):
         if other is None:
             return False
-        if self.type < other.type:
-            return True
-        elif other.type < self.type:
+        return self.key < other.key
+
+    def __le__(self, other):
+        if other is None:
             return False
-        elif self.type == other.type:
-            return self.compare_ranks(other) == -1
+        return self.key <= other.key
+
+    def __gt__(self, other):
+        if other is None:
+            return True
+        return self.key > other.key
+
+    def __ge__(self, other):
+        if other is None:
+            return True
+        return self.key >= other.key
 
     def __eq__(self, other):
         if other is None:
             return False
-        return self.type == other.type and self.compare_ranks(other) == 0
+        return self.key == other.key
+
+    def __ne__(self, other):
+        if other is None:
+            return True
+        return self.key != other.key
 
     def get_two_pair_info(self):
         """For a two pair hand, returns the ranks of the two pairs and kicker."""
@@ -170,40 +217,7 @@ class TexasHand:
         """
         if self.type != other.type:
             raise ValueError('Hand types must match for the compare_ranks method.')
-        my_ranks = np.sort([RANKS[card[0]] for card in self.playable_cards])[::-1]
-        other_ranks = np.sort([RANKS[card[0]] for card in other.playable_cards])[::-1]
-        # Two pair is a special case that is especially difficult to rank.
-        if self.type == TWO_PAIR:
-            my_pairs, my_kicker = self.get_two_pair_info()
-            other_pairs, other_kicker = other.get_two_pair_info()
-            for my_pair, other_pair in zip(my_pairs, other_pairs):
-                if my_pair < other_pair:
-                    return -1
-                if my_pair > other_pair:
-                    return 1
-
-            if my_kicker < other_kicker:
-                return -1
-            if my_kicker > other_kicker:
-                return 1
-            return 0    # Both pairs and the kicker are all equal.
-
-        # When there are low ace straights (A 2 3 4 5) we need to count the ace
-        # as low by transforming it to a 1.
-        if self.type in (STRAIGHT, STRAIGHT_FLUSH):
-            if 14 in my_ranks and 5 in my_ranks:    # 14 is Ace
-                my_ranks[0] = 1     # Transform the ace (in the front) to a 1
-                my_ranks = np.sort(my_ranks)[::-1]
-            if 14 in other_ranks and 5 in other_ranks:
-                other_ranks[0] = 1
-                other_ranks = np.sort(other_ranks)[::-1]
-
-        for i in range(len(my_ranks)):
-            if my_ranks[i] < other_ranks[i]:
-                return -1
-            elif my_ranks[i] > other_ranks[i]:
-                return 1
-        return 0
+        return (self.key > other.key) - (self.key < other.key)
 
 
     def __str__(self):
@@ -1,18 +1,82 @@
+import os
+import sys
+import subprocess
 import unittest
 import itertools
 import random
 import copy
+import pickle
+from collections import Counter
 from tqdm import tqdm, trange
 from scipy import stats
-from matplotlib import pyplot as plt
 from texas_hands import *
 from hand_abstraction import *
 from texas_utils import *
 from hand_table import *
 from trainer import *
+try:
+    import _hotkernels
+except ImportError:
+    _hotkernels = None
+
+
+# Hands used by the comparison tests of every hand evaluator
+COMPARISON_HANDS = {
+    'royal_flush': ('Jd', 'As', 'Js', 'Ks', 'Qs', 'Ts', '2c'),
+    'straight_flush': ('7d', '2c', '8d', 'Jd', '9d', '3d', 'Td'),
+    'four': ('2h', '2c', '3d', '5c', '7d', '2d', '2s'),
+    'full_house': ('As', 'Jd', 'Qs', 'Jc', '2c', 'Ac', 'Ah'),
+    'same_full_house': ('As', 'Js', '2s', 'Jc', '2c', 'Ac', 'Ah'),
+    'flush': ('Jh', '2c', '2h', '3h', '7h', 'As', '9h'),
+    'same_flush': ('Jh', '2c', '2h', '3h', '7h', '2s', '9h'),
+    'better_flush': ('Jh', '2c', 'Ah', '3h', '7h', 'Ts', '9h'),
+    'straight': ('Ah', '2s', '3d', '5c', '4c'),
+    'trips': ('5d', '4c', '6d', '6h', '6c'),
+    'two_pair': ('6d', '5c', '5h', 'Ah', 'Ac'),
+    'better_two_pair': ('Td', 'Th', 'Ad', 'Ac', '6h'),
+    'pair': ('Ah', '2d', '2s', '3c', '5c'),
+    'ace_pair': ('Ac', 'As', '2s', '3d', '6c'),
+    'better_kicker': ('Ac', 'As', 'Ts', '3d', '6c'),
+    'high_card': ('Kh', 'Ah', 'Qh', '2h', '3s'),
+    'other_high_card': ('Ks', 'As', 'Qs', '2h', '3s'),
+}
+
+
+class ComparisonTests:
+    """Hand comparison tests shared by the hand evaluators.
+
+    Subclasses mix this into a TestCase and define evaluate(cards), which
+    returns something that compares the same way the hands do.
+    """
 
+    def test_comparisons(self):
+        # TODO: Write more tricky hand comparison tests to make sure it really works.
+        hands = {name: self.evaluate(cards) for name, cards in COMPARISON_HANDS.items()}
+
+        # Test random hand type comparisons
+        self.assertTrue(hands['royal_flush'] > hands['straight_flush'])
+        self.assertTrue(hands['royal_flush'] > hands['trips'])
+        self.assertTrue(hands['straight_flush'] > hands['full_house'])
+        self.assertTrue(hands['trips'] > hands['two_pair'])
+        self.assertTrue(hands['high_card'] < hands['pair'])
+        self.assertTrue(hands['straight'] <= hands['flush'])
 
-class HandTests(unittest.TestCase):
+        # Test rank levels within hands
+        self.assertTrue(hands['better_two_pair'] > hands['two_pair'])
+        self.assertTrue(hands['better_flush'] > hands['flush'])
+        self.assertTrue(hands['better_kicker'] > hands['ace_pair'])
+
+        # Test for ties
+        self.assertEqual(hands['better_two_pair'], hands['better_two_pair'])
+        self.assertEqual(hands['same_full_house'], hands['full_house'])
+        self.assertEqual(hands['other_high_card'], hands['high_card'])
+        self.assertEqual(hands['same_flush'], hands['flush'])
+
+
+class HandTests(ComparisonTests, unittest.TestCase):
+
+    def evaluate(self, cards):
+        return TexasHand(cards)
 
     def test_classification(self):
         royal_flush = TexasHand(('As', 'Js', 'Ks', 'Qs', 'Ts'))
@@ -101,92 +165,97 @@ class HandTests(unittest.TestCase):
         with self.assertRaises(TypeError):
             TexasHand((1, 2, 3, 4, 5))
 
-    def test_comparisons(self):
-        # TODO: Write more tricky hand comparison tests to make sure it really works.
-        royal_flush = TexasHand(('Jd', 'As', 'Js', 'Ks', 'Qs', 'Ts', '2c'))
-        straight_flush = TexasHand(('7d', '2c', '8d', 'Jd', '9d', '3d', 'Td'))
-        four = TexasHand(('2h', '2c', '3d', '5c', '7d', '2d', '2s'))
-        full_house = TexasHand(('As', 'Jd', 'Qs', 'Jc', '2c', 'Ac', 'Ah'))
-        same_full_house = TexasHand(('As', 'Js', '2s', 'Jc', '2c', 'Ac', 'Ah'))
-        flush = TexasHand(('Jh', '2c', '2h', '3h', '7h', 'As', '9h'))
-        same_flush = TexasHand(('Jh', '2c', '2h', '3h', '7h', '2s', '9h'))
-        better_flush = TexasHand(('Jh', '2c', 'Ah', '3h', '7h', 'Ts', '9h'))
-        straight = TexasHand(('Ah', '2s', '3d', '5c', '4c'))
-        trips = TexasHand(('5d', '4c', '6d', '6h', '6c'))
-        two_pair = TexasHand(('6d', '5c', '5h', 'Ah', 'Ac'))
-        better_two_pair = TexasHand(('Td', 'Th', 'Ad', 'Ac', '6h'))
-        pair = TexasHand(('Ah', '2d', '2s', '3c', '5c'))
-        ace_pair = TexasHand(('Ac', 'As', '2s', '3d', '6c'))
-        better_kicker = TexasHand(('Ac', 'As', 'Ts', '3d', '6c'))
-        high_card = TexasHand(('Kh', 'Ah', 'Qh', '2h', '3s'))
-        other_high_card = TexasHand(('Ks', 'As', 'Qs', '2h', '3s'))
-
-        # Test random hand type comparisons
-        self.assertTrue(royal_flush > straight_flush)
-        self.assertTrue(royal_flush > trips)
-        self.assertTrue(straight_flush > full_house)
-        self.assertTrue(trips > two_pair)
-        self.assertTrue(high_card < pair)
-        self.assertTrue(straight <= flush)
-
-        # Test rank levels within hands
-        self.assertTrue(better_two_pair > two_pair)
-        self.assertTrue(better_flush > flush)
-        self.assertTrue(better_kicker > ace_pair)
 
-        # Test for ties
-        self.assertEqual(better_two_pair, better_two_pair)
-        self.assertEqual(same_full_house, full_house)
-        self.assertEqual(other_high_card, high_card)
-        self.assertEqual(same_flush, flush)
-
-
-class TestFastTexasHands(unittest.TestCase):
-
-    def test_comparisons(self):
-        table = HandTable()
-        royal_flush = table[('Jd', 'As', 'Js', 'Ks', 'Qs', 'Ts', '2c')]
-        straight_flush = table[('7d', '2c', '8d', 'Jd', '9d', '3d', 'Td')]
-        four = table[('2h', '2c', '3d', '5c', '7d', '2d', '2s')]
-        full_house = table[('As', 'Jd', 'Qs', 'Jc', '2c', 'Ac', 'Ah')]
-        same_full_house = table[('As', 'Js', '2s', 'Jc', '2c', 'Ac', 'Ah')]
-        flush = table[('Jh', '2c', '2h', '3h', '7h', 'As', '9h')]
-        same_flush = table[('Jh', '2c', '2h', '3h', '7h', '2s', '9h')]
-        better_flush = table[('Jh', '2c', 'Ah', '3h', '7h', 'Ts', '9h')]
-        straight = table[('Ah', '2s', '3d', '5c', '4c')]
-        trips = table[('5d', '4c', '6d', '6h', '6c')]
-        two_pair = table[('6d', '5c', '5h', 'Ah', 'Ac')]
-        better_two_pair = table[('Td', 'Th', 'Ad', 'Ac', '6h')]
-        pair = table[('Ah', '2d', '2s', '3c', '5c')]
-        ace_pair = table[('Ac', 'As', '2s', '3d', '6c')]
-        better_kicker = table[('Ac', 'As', 'Ts', '3d', '6c')]
-        high_card = table[('Kh', 'Ah', 'Qh', '2h', '3s')]
-        other_high_card = table[('Ks', 'As', 'Qs', '2h', '3s')]
-
-        # Test random hand type comparisons
-        self.assertTrue(royal_flush > straight_flush)
-        self.assertTrue(royal_flush > trips)
-        self.assertTrue(straight_flush > full_house)
-        self.assertTrue(trips > two_pair)
-        self.assertTrue(high_card < pair)
-        self.assertTrue(straight <= flush)
-
-        # Test rank levels within hands
-        self.assertTrue(better_two_pair > two_pair)
-        self.assertTrue(better_flush > flush)
-        self.assertTrue(better_kicker > ace_pair)
-
-        # Test for ties
-        self.assertEqual(better_two_pair, better_two_pair)
-        self.assertEqual(same_full_house, full_house)
-        self.assertEqual(other_high_card, high_card)
-        self.assertEqual(same_flush, flush)
+class TestFastTexasHands(ComparisonTests, unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.table = HandTable()
+
+    def evaluate(self, cards):
+        return self.table[cards]
+
+    def test_strengths(self):
+        # The batched lookup has to agree with looking up each hand on its own
+        rng = np.random.default_rng(0)
+        for n_cards in 5, 6, 7:
+            hands = np.array([rng.choice(52, n_cards, replace=False) for _ in range(500)],
+                             dtype=np.uint8)
+            strengths = self.table.strengths(hands)
+            for hand, strength in zip(hands, strengths):
+                self.assertEqual(strength, self.table[[id_card(c) for c in hand]])
+        cards = list(COMPARISON_HANDS.values())[:3]
+        self.assertEqual(list(self.table.strengths(cards)), [self.table[c] for c in cards])
+
+    def test_strengths_then_fork(self):
+        # A process that forks a pool after a batched lookup has to be able to
+        # exit. The hang only shows at interpreter exit, so run it separately.
+        script = ('import multiprocessing as mp\n'
+                  'from hand_table import HandTable\n'
+                  'from texas_utils import deal_batch, DECK_IDS\n'
+                  'HandTable().strengths(deal_batch(DECK_IDS, 100, 7))\n'
+                  'with mp.Pool(2) as p:\n'
+                  '    p.map(abs, range(4))\n')
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        subprocess.run([sys.executable, '-c', script], env=env, check=True, timeout=120)
+
+    def test_strengths_wrong_size(self):
+        with self.assertRaises(ValueError):
+            self.table.strengths([])
+        with self.assertRaises(ValueError):
+            self.table.strengths(np.zeros((3, 4), dtype=np.uint8))
+
+
+class IsomorphicTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # Random hands with the cards in random order
+        rng = np.random.default_rng(0)
+        cls.hands = np.array([rng.choice(52, 5, replace=False) for _ in range(50000)],
+                             dtype=np.uint8)
+        cls.batch = isomorphic_hands(cls.hands)
+
+    def check_kernel(self, kernel):
+        for hand, expected in zip(self.hands, self.batch):
+            np.testing.assert_array_equal(kernel(hand), expected)
+
+    def test_numba_matches_batch(self):
+        self.check_kernel(isomorphic_ids_numba)
+
+    @unittest.skipIf(_hotkernels is None, 'compiled kernels are not built')
+    def test_compiled_matches_batch(self):
+        self.check_kernel(_hotkernels.isomorphic_ids)
+
+    def test_isomorphic_hand(self):
+        self.assertEqual(isomorphic_hand(('Kd', '2d', '3h', '4c', '5s')),
+                         ('2s', '3h', '4d', '5c', 'Ks'))
+        for hand, expected in zip(self.hands[:2000], self.batch):
+            cards = [id_card(c) for c in hand]
+            iso = isomorphic_hand(cards)
+            # Five distinct sorted cards with the same ranks as the original
+            # hand, and the same number of cards in each suit
+            self.assertEqual(len(set(iso)), 5)
+            self.assertEqual(list(iso), sorted(iso))
+            self.assertEqual(sorted(rank(c) for c in iso), sorted(rank(c) for c in cards))
+            self.assertEqual(sorted(Counter(suit(c) for c in iso).values()),
+                             sorted(Counter(suit(c) for c in cards).values()))
+            # The order the cards are given in doesn't matter
+            self.assertEqual(isomorphic_hand(cards[::-1]), iso)
+            # Same hand as the batched version, in isomorphic_hand's suits
+            self.assertEqual(iso, tuple(sorted(rank(id_card(c)) + ISOMORPHIC_SUITS[suit_of(c)]
+                                               for c in expected)))
 
 
 class TestCardAbstractions(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # Build the abstraction once rather than once per test
+        cls.preflop_abstraction = PreflopAbstraction()
+
     def test_preflop_abstractions(self):
-        abst = PreflopAbstraction()
+        abst = self.preflop_abstraction
         self.assertEqual(len(abst.table), 1326)
         buckets = tuple(abst.table.values())
         n_buckets = len(np.unique(buckets))
@@ -267,13 +336,23 @@ class TestCardAbstractions(unittest.TestCase):
         hand = ('4c', '7d', 'As', '2h', '9h', '9c', 'Tc')
         self.assertTrue(equity(hand, samples=1000) < 0.2)
 
+# Building the flop abstraction from scratch takes hours, so only run these
+# tests when it has already been computed and saved to disk.
+@unittest.skipUnless(os.path.isfile(FLOP_EQUITY_DISTIBUTIONS) and os.path.isfile(FLOP_SAVE_NAME),
+                     'flop abstraction has not been computed')
 class ClusterTests(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        with open(FLOP_EQUITY_DISTIBUTIONS, 'rb') as f:
+            cls.flop_equities = pickle.load(f)
+        cls.flop_abstraction = FlopAbstraction()
+
     def test_flop_coefficient(self):
         # This test makes sure that the average distance within clusters is less than the average
         # distance between the cluster and other hands.
-        equities = pickle.load(open('flop_equity.pkl', 'rb'))
-        abstraction = FlopAbstraction()
+        equities = self.flop_equities
+        abstraction = self.flop_abstraction
         hands = list(equities.keys())
         np.random.shuffle(hands)
         n_buckets = np.max(list(abstraction.abstraction.table.values())) + 1
@@ -406,6 +485,12 @@ class ActionTests(unittest.TestCase):
         # Can't min raise because not enough chips
         self.assertEqual(history.legal_actions(), ('fold', 'call', 'all-in'))
 
+    def test_eq(self):
+        self.assertEqual(self.histories[2], ActionHistory(preflop=['raise']))
+        self.assertNotEqual(self.histories[2], self.histories[5])
+        self.assertNotEqual(self.histories[2], None)
+        self.assertNotEqual(self.histories[2], str(self.histories[2]))
+
     def test_hand_over(self):
         pass
 
@@ -432,7 +517,61 @@ class InfoSetTests(unittest.TestCase):
         self.assertEqual(infoset, infoset2)
 
     def test_hash(self):
-        pass
+        deck = get_deck()
+        history = ActionHistory(preflop=['raise', '3-bet', 'call'], flop=['check'])
+        infoset = InfoSet(deck, history)
+        self.assertEqual(hash(infoset), hash(InfoSet(deck, copy.deepcopy(history))))
+        # Same cards with a different history are a different infoset
+        other = InfoSet(deck, ActionHistory(preflop=['limp', 'call'], flop=['check']))
+        self.assertNotEqual(infoset, other)
+        self.assertEqual(len({infoset, other}), 2)
+
+    def test_pickle(self):
+        # The cached hash depends on the process' string hash seed, so it has
+        # to be recomputed when a pickled infoset is loaded
+        history = ActionHistory(preflop=['raise', '3-bet', 'call'], flop=['check'])
+        infoset = InfoSet(get_deck(), history)
+        self.assertNotIn('_hash', infoset.__getstate__())
+        loaded = pickle.loads(pickle.dumps({infoset: 1}))
+        self.assertIn(infoset, loaded)
+        self.assertEqual(hash(next(iter(loaded))), hash(infoset))
+
+
+class NodeTests(unittest.TestCase):
+
+    def setUp(self):
+        history = ActionHistory(preflop=('limp', 'call'))
+        self.node = Node(InfoSet(get_deck(), history))
+        self.actions = history.legal_actions()
+
+    def test_current_strategy(self):
+        self.node.add_regret('pot', 3)
+        self.node.add_regret('check', 1)
+        self.node.add_regret('all-in', -2)
+        strategy = self.node.current_strategy()
+        self.assertEqual(strategy, {'check': 0.25, 'half_pot': 0, 'pot': 0.75, 'all-in': 0})
+
+    def test_no_positive_regret(self):
+        # Regrets that sum to a negative number used to divide by zero. With no
+        # positive regret, every legal action is equally likely.
+        uniform = {action: 1 / len(self.actions) for action in self.actions}
+        self.assertEqual(self.node.current_strategy(), uniform)
+        self.node.add_regret('pot', -3)
+        self.node.add_regret('check', -1)
+        self.assertEqual(self.node.current_strategy(), uniform)
+        # Regrets that sum to zero still play the one positive-regret action
+        self.node.add_regret('half_pot', 4)
+        self.assertEqual(self.node.current_strategy(),
+                         {'check': 0, 'half_pot': 1, 'pot': 0, 'all-in': 0})
+
+    def test_cumulative_strategy(self):
+        self.node.add_regret('pot', 1)
+        self.node.current_strategy(0.5)
+        self.node.current_strategy(0.5)
+        self.assertEqual(self.node.cumulative_strategy()['pot'], 1)
+        # Reading the average strategy doesn't change the running sums
+        self.assertEqual(sum(self.node.weighted_strategy_sum), 1)
+        self.assertEqual(self.node.cumulative_strategy()['pot'], 1)
 
 
 if __name__ == '__main__':
@@ -1,20 +1,86 @@
 from itertools import product
+from functools import lru_cache
 from tqdm import tqdm
 import numpy as np
 import multiprocessing as mp
+from numba import njit
 
 (HIGH_CARD, PAIR, TWO_PAIR, THREE_OF_A_KIND, STRAIGHT, FLUSH, FULL_HOUSE,
  FOUR_OF_A_KIND, STRAIGHT_FLUSH, ROYAL_FLUSH) = range(10)
 RANK, SUIT = range(2)
+# 13-bit rank masks (bit 0 is the deuce) of every straight, including the
+# ace-low wheel A2345
+WHEEL_MASK = 0b1000000001111
+ROYAL_MASK = 0b1111100000000
+STRAIGHT_MASKS = frozenset([0b11111 << i for i in range(9)] + [WHEEL_MASK])
+
+
+def make_type_table():
+    """Returns a lookup table from a 5-card hand's signature to its hand type.
+
+    The signature is flush << 4 | straight << 3 | pairs, where pairs counts the
+    pairs of cards that share a rank: 0 for high card, 1 pair, 2 two pair,
+    3 trips, 4 full house, and 6 quads. Signatures that can't happen with a
+    single deck (like a flush containing a pair) are left as None.
+    """
+    table = [None] * 32
+    for pairs, hand_type in ((0, HIGH_CARD), (1, PAIR), (2, TWO_PAIR), (3, THREE_OF_A_KIND),
+                             (4, FULL_HOUSE), (6, FOUR_OF_A_KIND)):
+        table[pairs] = hand_type
+    table[1 << 3] = STRAIGHT
+    table[1 << 4] = FLUSH
+    table[1 << 4 | 1 << 3] = STRAIGHT_FLUSH
+    return tuple(table)
+
+HAND_TYPES = make_type_table()
 
 RANKS = {'A': 14, 'K': 13, 'Q': 12, 'J': 11, 'T': 10, '9': 9, '8': 8, '7': 7,
          '6': 6, '5': 5, '4': 4, '3': 3, '2': 2}
 SUITS = ('c', 'd', 'h', 's')
+SUIT_INDEX = {suit: i for i, suit in enumerate(SUITS)}
+# Every card string mapped to its packed id (see card_id), so that parsing a
+# card is a single dict lookup.
+CARD_IDS = {rank + suit: (RANKS[rank] - 2) << 2 | SUIT_INDEX[suit]
+            for suit in SUITS for rank in RANKS}
+# Inverse of CARD_IDS: ID_CARDS[card_id(card)] == card
+ID_CARDS = tuple(sorted(CARD_IDS, key=CARD_IDS.get))
+
+
+DECK = tuple(rank + suit for suit in SUITS for rank in RANKS)
+# Packed ids of the whole deck. Since ids run from 0 to 51, DECK_IDS[i] == i.
+DECK_IDS = np.arange(52, dtype=np.uint8)
 
 
 def get_deck():
-    """Returns the standard 52-card deck, represented as a list of strings."""
-    return [rank + suit for suit in SUITS for rank in RANKS]
+    """Returns the standard 52-card deck, represented as a list of strings.
+
+    This is a fresh copy of DECK since callers shuffle it and remove cards.
+    """
+    return list(DECK)
+
+
+def card_id(card):
+    """Packs a card string like 'Ah' into a single integer in the range [0, 52).
+
+    The rank is stored in the high bits and the suit in the low two bits, so
+    rank_of(id) = (id >> 2) + 2 and suit_of(id) = id & 3.
+    """
+    return CARD_IDS[card]
+
+
+def id_card(card):
+    """Unpacks a card id back into its string format, e.g. 'Ah'."""
+    return ID_CARDS[card]
+
+
+def rank_of(card):
+    """Numeric rank (2-14) of a packed card id. Also works on arrays of ids."""
+    return (card >> 2) + 2
+
+
+def suit_of(card):
+    """Suit index (into SUITS) of a packed card id. Also works on arrays of ids."""
+    return card & 3
 
 
 def rank(card):
@@ -35,7 +101,25 @@ def unique_cards(cards):
 
 
 def archetypal_hand(hand):
-    """Returns 'archetypal' hand isomorphic to input hand."""
+    """Returns 'archetypal' hand isomorphic to input hand.
+
+    Cached, since the trainer keeps looking up the same hands. Code that walks
+    through every hand once should call compute_archetypal_hand instead.
+    """
+    # Every ordering of the hole cards and flop shares one cache entry
+    return _cached_archetypal_hand(tuple(sorted(hand[:2])) + tuple(sorted(hand[2:5]))
+                                   + tuple(hand[5:]))
+
+
+# Sized for the hands one trainer iteration keeps coming back to. A bigger
+# cache mostly fills up with hands that are never seen again.
+@lru_cache(maxsize=1 << 14)
+def _cached_archetypal_hand(hand):
+    return compute_archetypal_hand(hand)
+
+
+def compute_archetypal_hand(hand):
+    """Uncached archetypal_hand."""
     # Sort the preflop and flop since order doesn't matter within those streets
     hand = list(hand)
     hand[:5] = sorted(hand[:2]) + sorted(hand[2:5])
@@ -72,34 +156,151 @@ def archetypal_hand(hand):
 
 
 def make_isomorphic_suits():
-    table = {}
-    suits = ['s', 'h', 'd', 'c']
-    for non_iso in product(suits, suits, suits, suits, suits):
-        remaining = suits.copy()
-        result = []
+    """Returns a table of the isomorphic suits of every 5-card suit pattern.
+
+    Row i describes the 5 suits packed 2 bits apiece into i (the first card's
+    suit in the lowest bits). Each suit is replaced by the order in which it
+    first appears, so the pattern (h, c, h, s, c) maps to (0, 1, 0, 2, 1).
+    """
+    table = np.zeros((4 ** 5, 5), dtype=np.uint8)
+    for index in range(4 ** 5):
         mapping = {}
-        for s in non_iso:
-            if s not in mapping:
-                mapping[s] = remaining.pop(0)
-        table[non_iso] = [mapping[s] for s in non_iso]
+        for i in range(5):
+            suit = index >> 2 * i & 3
+            if suit not in mapping:
+                mapping[suit] = len(mapping)
+            table[index, i] = mapping[suit]
     return table
 
-isomorphic_suits = make_isomorphic_suits()
+ISOMORPHIC_SUITS_TABLE = make_isomorphic_suits()
+
+
+@njit(cache=True)
+def isomorphic_ids_numba(hand):
+    """Returns the suit isomorphic version of a 5-card hand of packed card ids.
+
+    The cards are sorted, then each suit is replaced by the order in which it
+    first appears (the first suit seen becomes 0, the next 1, and so on) using
+    ISOMORPHIC_SUITS_TABLE, and the result is sorted again.
+
+    Inputs:
+        hand - np.uint8 array of 5 packed card ids
+
+    Returns:
+        result - sorted np.uint8 array of the isomorphic card ids
+    """
+    result = np.sort(hand)
+    index = 0
+    for i in range(5):
+        index |= (result[i] & 3) << 2 * i
+    iso_suits = ISOMORPHIC_SUITS_TABLE[index]
+    for i in range(5):
+        result[i] = (result[i] & 0xFC) | iso_suits[i]
+    return np.sort(result)
+
+try:
+    # Compiled build of the same kernel with no JIT warm-up (see _hotkernels.pyx)
+    from _hotkernels import isomorphic_ids
+except ImportError:
+    isomorphic_ids = isomorphic_ids_numba
+
+
+def isomorphic_hands(hands):
+    """Vectorized isomorphic_ids over a whole batch of 5-card hands.
+
+    Inputs:
+        hands - (N, 5) np.uint8 array of packed card ids
+
+    Returns:
+        result - (N, 5) np.uint8 array where each row is sorted and suit
+            isomorphic, matching isomorphic_ids row by row
+    """
+    hands = np.sort(hands, axis=1)
+    suits = (hands & 3).astype(np.intp)
+    index = suits[:, 0] | suits[:, 1] << 2 | suits[:, 2] << 4 | suits[:, 3] << 6 | suits[:, 4] << 8
+    result = (hands & 0xFC) | ISOMORPHIC_SUITS_TABLE[index]
+    return np.sort(result, axis=1)
+
+
+# Suits handed out by isomorphic_hand, in order of first appearance
+ISOMORPHIC_SUITS = ('s', 'h', 'd', 'c')
+
 
-# TODO: This function is the bottleneck of the flop abstraction code. Anything
-# to speed it up will help greatly.
 def isomorphic_hand(hand):
-    hand = sorted(hand)
-    suits = tuple([card[SUIT] for card in hand])
-    iso_suits = isomorphic_suits[suits]
-    result = []
-    for i, card in enumerate(hand):
-        result.append(card[RANK] + iso_suits[i])
-    return tuple(sorted(result))
+    """String wrapper around isomorphic_ids, e.g. ('Kd', '2d', ...) -> ('2s', 'Ks', ...)"""
+    return _isomorphic_hand(tuple(sorted(hand)))
+
+
+# Cached on the sorted hand since the trainer keeps asking for the same hands.
+# Batches of id arrays should use isomorphic_hands.
+@lru_cache(maxsize=1 << 14)
+def _isomorphic_hand(hand):
+    ids = isomorphic_ids(np.array([CARD_IDS[card] for card in hand], dtype=np.uint8))
+    return tuple(sorted([ID_CARDS[c][RANK] + ISOMORPHIC_SUITS[suit_of(c)] for c in ids]))
+
+
+def deal_batch(deck, n, n_cards):
+    """Deals n_cards from the deck for n independent games at once.
+
+    Each row is a uniform random draw without replacement, found by keeping
+    the n_cards smallest of one random key per card (a vectorized partial
+    shuffle).
+
+    Inputs:
+        deck - np.uint8 array of the packed ids of the cards left in the deck
+        n - Number of games to deal
+        n_cards - How many cards to deal to each game
+
+    Returns:
+        cards - (n, n_cards) np.uint8 array of packed card ids
+    """
+    keys = np.random.random((n, len(deck)))
+    return deck[np.argpartition(keys, n_cards - 1, axis=1)[:, :n_cards]]
+
+
+class _Indexed:
+    """Wraps a function to take and return (index, value) pairs.
+
+    Lets pbar_map consume results in whatever order the workers finish them
+    and then put them back in order.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def __call__(self, item):
+        index, value = item
+        return index, self.function(value)
+
+
+# Worker pool shared by every pbar_map call, created on first use so that
+# building several abstractions in a row only forks the workers once.
+_POOL = None
+
+
+def _worker_init():
+    """Runs once in each pool worker when it starts."""
+    # Forked workers inherit the parent's NumPy random state, so without a
+    # fresh seed every worker would draw the same equity samples.
+    np.random.seed()
+
+
+def get_pool():
+    global _POOL
+    if _POOL is None:
+        _POOL = mp.Pool(mp.cpu_count(), initializer=_worker_init)
+    return _POOL
 
 
 def pbar_map(function, iterator):
-    with mp.Pool(mp.cpu_count()) as p:
-        result = list(tqdm(p.imap(function, iterator), total=len(iterator), smoothing=0.1))
+    """Parallel map with a progress bar. Results are in the same order as iterator."""
+    n = len(iterator)
+    # Send tasks in batches so cheap functions aren't dominated by the cost of
+    # pickling every single task through the pool's queue.
+    chunksize = max(1, n // (mp.cpu_count() * 16))
+    result = [None] * n
+    tasks = get_pool().imap_unordered(_Indexed(function), enumerate(iterator), chunksize=chunksize)
+    for index, value in tqdm(tasks, total=n, smoothing=0.1):
+        result[index] = value
     return result
 
@@ -15,6 +15,7 @@ SAVE_PATH = 'blueprint.pkl'
 # TODO - Parameters
 
 np.random.seed(123)
+RNG = np.random.default_rng(123)
 
 
 class Trainer:
@@ -26,9 +27,9 @@ class Trainer:
         print('Beginning training...')
         deck = get_deck()
         for i in trange(iterations):
-            np.random.shuffle(deck)
+            RNG.shuffle(deck)
             self.iterate(0, deck)
-            np.random.shuffle(deck)
+            RNG.shuffle(deck)
             self.iterate(1, deck)
 
         with open(SAVE_PATH, 'wb') as f:
@@ -100,9 +101,9 @@ class Trainer:
         player_strength = HAND_TABLE[player_hand]
         opponent_strength = HAND_TABLE[opponent_hand]
         if player_strength > opponent_strength:
-            return pot / 2
+            return pot // 2
         elif player_strength < opponent_strength:
-            return -pot / 2
+            return -(pot // 2)
         elif player_strength == opponent_strength:
             return 0
 
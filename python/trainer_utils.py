@@ -1,4 +1,6 @@
 import json
+from array import array
+from functools import lru_cache
 from hand_abstraction import PreflopAbstraction, FlopAbstraction, TurnAbstraction, RiverAbstraction
 from hand_table import HandTable
 
@@ -9,6 +11,15 @@ TURN_ABSTRACTION = TurnAbstraction()
 RIVER_ABSTRACTION = RiverAbstraction()
 HAND_TABLE = HandTable()
 
+# The card abstraction for each street and how many cards (hole cards first,
+# then the board) it looks at.
+STREET_ABSTRACTIONS = {
+    'preflop': (PREFLOP_ABSTRACTION, 2),
+    'flop': (FLOP_ABSTRACTION, 5),
+    'turn': (TURN_ABSTRACTION, 6),
+    'river': (RIVER_ABSTRACTION, 7),
+}
+
 SMALL_BLIND = 50
 BIG_BLIND = 100
 STACK_SIZE = 20000
@@ -21,12 +32,6 @@ OPPONENT = 1
 BET_ABSTRACTION = [1]
 
 
-def conditional_copy(l):
-    if l is None:
-        return None
-    return list(l).copy()
-
-
 def normalize(dictionary):
     total = sum(dictionary.values())
     for key in dictionary:
@@ -48,330 +53,281 @@ def draw_deck(deck, player=0, return_hand=False):
         return hole, flop, turn, river
 
 
-class ActionHistory:
+# Position of each street in ActionHistory._key
+STREET_INDEX = {'preflop': 0, 'flop': 1, 'turn': 2, 'river': 3}
+
+# Legal actions given the previous action on the street (None if the street
+# has just started). Postflop actions are then filtered by the stack sizes.
+PREFLOP_LEGAL = {
+    None: ('fold', 'limp', 'raise'),
+    'limp': ('fold', 'call', 'raise'),
+    'raise': ('fold', 'call', '3-bet'),
+    '3-bet': ('fold', 'call', '4-bet', 'all-in'),
+    '4-bet': ('fold', 'call', 'all-in'),
+    'all-in': ('fold', 'call'),
+}
+POSTFLOP_LEGAL = {
+    None: ('check', 'half_pot', 'pot', 'all-in'),
+    'check': ('check', 'half_pot', 'pot', 'all-in'),
+    'half_pot': ('fold', 'call', 'min_raise', 'all-in'),
+    'pot': ('fold', 'call', 'min_raise', 'all-in'),
+    'min_raise': ('fold', 'call', 'min_raise', 'all-in'),
+    'all-in': ('fold', 'call'),
+}
+
+
+def street_is_over(street_history):
+    """Returns True once a call or two checks in a row have closed the betting."""
+    n = len(street_history)
+    if n == 0:
+        return False
+    last = street_history[-1]
+    if last == 'call':
+        return True
+    return n >= 2 and last == 'check' and street_history[-2] == 'check'
+
+
+@lru_cache(maxsize=1 << 20)
+def _pot_stack(preflop, flop, turn, river):
+    """Returns the pot and both stack sizes after the given betting on each street.
+
+    Cached on the street tuples, since the same histories come up over and over
+    during CFR traversal (legal_actions alone sizes the pot for every candidate
+    action).
+
+    Throws:
+        ValueError if the bets exceed the stack sizes.
+    """
+    stack_sizes = [STACK_SIZE, STACK_SIZE]
+    player = 0
+    prev_bet = 0
+    # Running total each player has put in, so calls don't re-sum every bet
+    totals = [0, 0]
+
+    # Preflop bet sizes
+    for action in preflop:
+        if action == 'limp':
+            bet = BIG_BLIND
+        elif action == 'call':
+            bet = totals[1-player] - totals[player]
+        elif action == 'raise':
+            bet = 3 * BIG_BLIND
+        elif action == '3-bet':
+            bet = 3 * prev_bet
+        elif action == '4-bet':
+            bet = 3 * prev_bet
+        elif action == 'all-in':
+            bet = stack_sizes[player]
+        elif action == 'fold':
+            break
+
+        prev_bet = bet
+        totals[player] += bet
+        stack_sizes[player] -= bet
+        player = 1 - player
+
+    pot = totals[0] + totals[1]
+    # Postfop bet sizes
+    for street in flop, turn, river:
+        player = 0
+        prev_bet = 0
+        for action in street:
+            if action == 'check':
+                bet = 0
+            elif action == 'call':
+                bet = totals[1-player] - totals[player]
+            elif action == 'half_pot':
+                bet = pot // 2
+            elif action == 'pot':
+                bet = pot
+            elif action == 'min_raise':
+                # TODO: This is wrong for re-raises (but it's consistent)
+                bet = 2 * prev_bet
+            elif action == 'all-in':
+                bet = stack_sizes[player]
+            elif action == 'fold':
+                break
 
-    def __init__(self, preflop=[], flop=[], turn=[], river=[]):
-        self.history = {
-            'preflop': preflop,
-            'flop': flop,
-            'turn': turn,
-            'river': river
-        }
-        self.street = 'preflop'
-        self.stacks = [STACK_SIZE, STACK_SIZE]
-        self.last_action = None
-        self.whose_turn = 0     # Player 0 is the dealer
-
-        # Parse action history
-        for street in 'preflop', 'flop', 'turn', 'river':
-            if street == 'preflop':
-                self.whose_turn = DEALER
-            else:
-                self.whose_turn = OPPONENT
+            prev_bet = bet
+            totals[player] += bet
+            stack_sizes[player] -= bet
+            player = 1 - player
+            pot += bet
 
-            if len(self.history[street]) == 0:
-                break
-            self.street = street
-            for action in self.history[street]:
-                self.last_action = action
-                self.stacks[self.whose_turn] -= action['amount']
-                self.whose_turn = 1 - self.whose_turn
+    if stack_sizes[0] < 0 or stack_sizes[1] < 0:
+        raise ValueError('Invalid bet history: bets exceed stack size.')
 
-    ## Public methods ##
+    return pot, tuple(stack_sizes)
 
-    def hand_over(self):
-        fold = self.last_action is not None and self.last_action['action'] == 'fold'
-        all_in = sum(self.stacks) == 0
-        showdown = self.street == 'river' and self.stacks[0] == self.stacks[1] and len(self.history['river']) >= 2
-        return fold or all_in or showdown
-
-    def pot_size(self):
-        return 2*STACK_SIZE - sum(stacks)
-
-    def legal_actions(self, ):
-        # Bets
-        if len(self.history[self.street]) > 0:
-            prev_bet = self.history[self.street][-1]['amount']
-            min_bet = max(BIG_BLIND, 2*prev_bet)
+
+class ActionHistory:
+
+    def __init__(self, preflop=(), flop=(), turn=(), river=()):
+        # Streets are stored as tuples so the history can key _pot_stack's cache
+        # and be extended without copying. A street that hasn't started is ().
+        self.preflop = tuple(preflop or ())
+        self.flop = tuple(flop or ())
+        self.turn = tuple(turn or ())
+        self.river = tuple(river or ())
+        # Hashed and compared directly instead of formatting str(self)
+        self._key = (self.preflop, self.flop, self.turn, self.river)
+        # The history never changes, so work out where the hand is up to once
+        self._street = self._compute_street()
+        self._current = {'preflop': self.preflop, 'flop': self.flop, 'turn': self.turn,
+                         'river': self.river}.get(self._street)
+        if self._current is None:
+            self._whose_turn = 0
         else:
-            min_bet = BIG_BLIND
-        max_bet = self.stacks[self.whose_turn]
-        for bet in BET_ABSTRACTION:
-            if min_bet <= bet * pot <= max_bet:
-                actions.append({'action': 'bet', 'amount': bet * pot})
+            self._whose_turn = len(self._current) % 2         # TODO: Bug? Should this be +1 because the dealer doesn't start betting on later streets?
 
-        # Calls
-        # START HERE: Return correct call amount, and also fold if to_call > 0
-        return actions
+    def pot_size(self, return_stack_sizes=False):
+        pot, stack_sizes = _pot_stack(self.preflop, self.flop, self.turn, self.river)
+        if return_stack_sizes:
+            return pot, list(stack_sizes)
+        else:
+            return pot
 
+    def stack_sizes(self):
+        return self.pot_size(return_stack_sizes=True)[1]
 
-    ## Private methods ##
+    def street(self):
+        return self._street
 
-    def __str__(self):
-        return str(self.history)
+    def _compute_street(self):
+        street = ''
+        if self.river:
+            if street_is_over(self.river):
+                street = 'over'
+            else:
+                street = 'river'
+        elif self.turn:
+            if street_is_over(self.turn):
+                street = 'river'
+            else:
+                street = 'turn'
+        elif self.flop:
+            if street_is_over(self.flop):
+                street = 'turn'
+            else:
+                street = 'flop'
+        else:
+            if street_is_over(self.preflop):
+                street = 'flop'
+            else:
+                street = 'preflop'
+        return street
 
-    def __hash__(self):
-        return hash(str(self))
+    def whose_turn(self):
+        return self._whose_turn
 
-    def __add__(self):
-        pass
+    def current_street_history(self):
+        return self._current
+
+    def legal_actions(self):
+        if self._street == 'over':
+            return ()
+        prev_action = self._current[-1] if self._current else None
+        if self._street == 'preflop' and prev_action in PREFLOP_LEGAL:
+            return PREFLOP_LEGAL[prev_action]
+
+        # Postflop
+        if prev_action not in POSTFLOP_LEGAL:
+            raise ValueError('Unknown previous action')
+        # Size the pot after each candidate straight from the street tuples
+        # rather than building a trial ActionHistory for every one.
+        key = list(self._key)
+        street = STREET_INDEX[self._street]
+        actions = []
+        for action in POSTFLOP_LEGAL[prev_action]:
+            key[street] = self._current + (action,)
+            try:
+                _pot_stack(*key)
+            except ValueError:
+                # The action is invalid because the bets are larger than
+                # the stack sizes
+                continue
+            actions.append(action)
+        return tuple(actions)
 
-    def __eq__(self):
+    def hand_over(self):
+        # TODO: Hand is also over after all-ins
+        if self.street() == 'over':
+            return True
+        if self.last_action() == 'fold':
+            return True
+        return False
+
+    def last_action(self):
+        history = self.current_street_history()
+        if history is None or len(history) == 0:
+            return None
+        else:
+            return history[-1]
+
+    def translate(self, pot_fractions):
+        # TODO
+        # Returns the history translated onto on-tree actions, given by the list
+        # of pot fractions.
         pass
 
+    def __str__(self):
+        return 'Preflop: {}, Flop: {}, Turn: {}, River: {}'.format(self.preflop, self.flop, self.turn, self.river)
 
+    def __hash__(self):
+        return hash(self._key)
 
-# class ActionHistory:
-
-#     def __init__(self, preflop=None, flop=None, turn=None, river=None):
-#         self.preflop = preflop
-#         self.flop = flop
-#         self.turn = turn
-#         self.river = river
-
-#     def pot_size(self, return_stack_sizes=False):
-#         stack_sizes = [STACK_SIZE, STACK_SIZE]
-#         player = 0
-#         prev_bet = 0
-#         bets = [[0], [0]]
-
-#         # Preflop bet sizes
-#         for action in self.preflop:
-#             if action == 'limp':
-#                 bets[player].append(BIG_BLIND)
-#             elif action == 'call':
-#                 bet = sum(bets[1-player]) - sum(bets[player])
-#                 bets[player].append(bet)
-#             elif action == 'raise':
-#                 bets[player].append(3 * BIG_BLIND)
-#             elif action == '3-bet':
-#                 bets[player].append(3 * prev_bet)
-#             elif action == '4-bet':
-#                 bets[player].append(3 * prev_bet)
-#             elif action == 'all-in':
-#                 bets[player].append(stack_sizes[player])
-#             elif action == 'fold':
-#                 break
-
-#             prev_bet = bets[player][-1]
-#             stack_sizes[player] -= prev_bet
-#             player = 1 - player
-
-#         pot = sum(bets[0]) + sum(bets[1])
-#         # Postfop bet sizes
-#         for street in self.flop, self.turn, self.river:
-#             if street is not None:
-#                 player = 0
-#                 prev_bet = 0
-#                 for action in street:
-#                     if action == 'check':
-#                         bet = 0
-#                     elif action == 'call':
-#                         bet = sum(bets[1-player]) - sum(bets[player])
-#                     elif action == 'half_pot':
-#                         bet = pot / 2
-#                     elif action == 'pot':
-#                         bet = pot
-#                     elif action == 'min_raise':
-#                         # TODO: This is wrong for re-raises (but it's consistent)
-#                         bet = 2 * prev_bet
-#                     elif action == 'all-in':
-#                         bet = stack_sizes[player]
-#                     elif action == 'fold':
-#                         break
-
-#                     bets[player].append(bet)
-#                     prev_bet = bets[player][-1]
-#                     stack_sizes[player] -= prev_bet
-#                     player = 1 - player
-#                     pot += bet
-
-#         if stack_sizes[0] < 0 or stack_sizes[1] < 0:
-#             raise ValueError('Invalid bet history: bets exceed stack size.')
-
-#         if return_stack_sizes:
-#             return pot, stack_sizes
-#         else:
-#             return pot
-
-#     def stack_sizes(self):
-#         return self.pot_size(return_stack_sizes=True)[1]
-
-#     def street(self):
-#         street = ''
-#         if self.river is not None:
-#             if self.street_is_over(self.river):
-#                 street = 'over'
-#             else:
-#                 street = 'river'
-#         elif self.turn is not None:
-#             if self.street_is_over(self.turn):
-#                 street = 'river'
-#             else:
-#                 street = 'turn'
-#         elif self.flop is not None:
-#             if self.street_is_over(self.flop):
-#                 street = 'turn'
-#             else:
-#                 street = 'flop'
-#         else:
-#             if self.street_is_over(self.preflop):
-#                 street = 'flop'
-#             else:
-#                 street = 'preflop'
-#         return street
-
-#     def street_is_over(self, street_history):
-#         return ((len(street_history) >= 1 and street_history[-1] == 'call')
-#                 or (len(street_history) >= 2 and street_history[-1] == 'check'
-#                                              and street_history[-2] == 'check'))
-
-#     def whose_turn(self):
-#         history = self.current_street_history()
-#         if history is None:
-#             return 0
-#         else:
-#             return len(history) % 2         # TODO: Bug? Should this be +1 because the dealer doesn't start betting on later streets?
-
-#     def current_street_history(self):
-#         street = self.street()
-#         if street == 'preflop':
-#             return self.preflop
-#         elif street == 'flop':
-#             return self.flop
-#         elif street == 'turn':
-#             return self.turn
-#         elif street == 'river':
-#             return self.river
-
-#     def legal_actions(self):
-#         history = self.current_street_history()
-#         if history is None or len(history) == 0:
-#             prev_action = None
-#         else:
-#             prev_action = history[-1]
-#         if self.street() == 'preflop':
-#             if prev_action is None:
-#                 return ('fold', 'limp', 'raise')
-#             elif prev_action == 'limp':
-#                 return ('fold', 'call', 'raise')
-#             elif prev_action == 'raise':
-#                 return ('fold', 'call', '3-bet')
-#             elif prev_action == '3-bet':
-#                 return ('fold', 'call', '4-bet', 'all-in')
-#             elif prev_action == '4-bet':
-#                 return ('fold', 'call', 'all-in')
-#             elif prev_action == 'all-in':
-#                 return ('fold', 'call')
-
-#         # Postflop
-#         pot = self.pot_size()
-#         if prev_action is None:
-#             actions = ['check', 'half_pot', 'pot', 'all-in']
-#         elif prev_action == 'check':
-#             actions = ['check', 'half_pot', 'pot', 'all-in']
-#         elif prev_action in ('half_pot', 'pot', 'min_raise'):
-#             actions = ['fold', 'call', 'min_raise', 'all-in']
-#         elif prev_action == 'all-in':
-#             actions = ['fold', 'call']
-#         else:
-#             raise ValueError('Unknown previous action')
-
-#         for action in actions.copy():
-#             trial = self + action
-#             try:
-#                 trial.pot_size()
-#             except ValueError:
-#                 # The action is invalid because the bets are larger than
-#                 # the stack sizes
-#                 actions.remove(action)
-
-#         return tuple(actions)
-
-#     def hand_over(self):
-#         # TODO: Hand is also over after all-ins
-#         if self.street() == 'over':
-#             return True
-#         if self.last_action() == 'fold':
-#             return True
-#         return False
-
-#     def last_action(self):
-#         history = self.current_street_history()
-#         if history is None or len(history) == 0:
-#             return None
-#         else:
-#             return history[-1]
-
-#     def translate(self, pot_fractions):
-#         # TODO
-#         # Returns the history translated onto on-tree actions, given by the list
-#         # of pot fractions.
-#         pass
-
-#     def __str__(self):
-#         return 'Preflop: {}, Flop: {}, Turn: {}, River: {}'.format(self.preflop, self.flop, self.turn, self.river)
-
-#     def __hash__(self):
-#         return hash(str(self))
-
-#     def __add__(self, action):
-#         preflop = conditional_copy(self.preflop)
-#         flop = conditional_copy(self.flop)
-#         turn = conditional_copy(self.turn)
-#         river = conditional_copy(self.river)
-
-#         street = self.street()
-#         action = (action,)
-#         if street == 'preflop':
-#             preflop += action
-#         elif street == 'flop':
-#             if flop is None:
-#                 flop = ()
-#             flop += action
-#         elif street == 'turn':
-#             if turn is None:
-#                 turn = ()
-#             turn += action
-#         elif street == 'river':
-#             if river is None:
-#                 river = ()
-#             river += action
-#         return ActionHistory(preflop, flop, turn, river)
-
-#     def __eq__(self, other):
-#         return str(self) == str(other)
+    def __add__(self, action):
+        street = self.street()
+        action = (action,)
+        if street == 'preflop':
+            return ActionHistory(self.preflop + action, self.flop, self.turn, self.river)
+        elif street == 'flop':
+            return ActionHistory(self.preflop, self.flop + action, self.turn, self.river)
+        elif street == 'turn':
+            return ActionHistory(self.preflop, self.flop, self.turn + action, self.river)
+        elif street == 'river':
+            return ActionHistory(self.preflop, self.flop, self.turn, self.river + action)
+        # The hand is over, so there is nothing to add to
+        return self
+
+    def __eq__(self, other):
+        if not isinstance(other, ActionHistory):
+            return NotImplemented
+        return self._key == other._key
 
 
 class InfoSet:
 
     def __init__(self, deck, history):
         self.history = history
-        street = history.street
-        player = history.whose_turn
-        hole, flop, turn, river = draw_deck(deck, player)
-        if street == 'preflop':
-            hand = hole
-            self.card_bucket = PREFLOP_ABSTRACTION[hand]
-        elif street == 'flop':
-            hand = hole + flop
-            self.card_bucket = FLOP_ABSTRACTION[hand]
-        elif street == 'turn':
-            hand = hole + flop + turn
-            self.card_bucket = TURN_ABSTRACTION[hand]
-        elif street == 'river':
-            hand = hole + flop + turn + river
-            self.card_bucket = RIVER_ABSTRACTION[hand]
-        else:
+        street = history.street()
+        player = history.whose_turn()
+        if street not in STREET_ABSTRACTIONS:
             raise ValueError('Unknown street.')
+        abstraction, n_cards = STREET_ABSTRACTIONS[street]
+        hand = draw_deck(deck, player, return_hand=True)[:n_cards]
+        self.card_bucket = abstraction[hand]
         self.hand = hand
+        # Infosets go straight into the trainer's node dict, so hash them once
+        self._hash = hash((self.card_bucket, history._key))
 
     def __eq__(self, other):
         return self.card_bucket == other.card_bucket and self.history == other.history
 
     # Make sure equal infosets are hashed equally
     def __hash__(self):
-        return self.card_bucket + hash(self.history)
+        return self._hash
+
+    # String hashes change between processes, so the cached hash mustn't be
+    # pickled along with the trainer's nodes. Recompute it on load instead.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_hash']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._hash = hash((self.card_bucket, self.history._key))
 
     def __str__(self):
         return ('Information set:\n\tPlayer: {}\n\tCard bucket: {}\n\tHistory: {}\n\tHand: {}'
@@ -386,47 +342,45 @@ class Node:
 
     def __init__(self, infoset, alpha=1.5, beta=0, gamma=2):
         self.infoset = infoset
-        self.regrets = {}
-        for action in self.infoset.legal_actions():
-            self.regrets[action] = 0
-        self.weighted_strategy_sum = self.regrets.copy()
+        self.actions = self.infoset.legal_actions()
+        # Regrets and strategy sums line up with self.actions. They are packed
+        # float32 arrays rather than dicts of Python floats, which halves the
+        # size of a node; the node table is what grows with training.
+        self.regrets = array('f', bytes(4 * len(self.actions)))
+        self.weighted_strategy_sum = array('f', self.regrets)
         self.t = 0
 
+    def uniform_strategy(self):
+        chance = 1 / len(self.actions)
+        return {action: chance for action in self.actions}
+
     def current_strategy(self, prob=0):
-        actions = self.infoset.legal_actions()
-        strategy = {}
-        if sum(self.regrets.values()) == 0:
-            for action in actions:
-                strategy[action] = 1
+        # Regret matching: play each action in proportion to its positive
+        # regret, or uniformly if no action has any.
+        positive = [regret if regret > 0 else 0 for regret in self.regrets]
+        total = sum(positive)
+        if total == 0:
+            strategy = [1 / len(positive)] * len(positive)
         else:
-            for action in actions:
-                chance = self.regrets[action]
-                if chance < 0:
-                    chance = 0
-                strategy[action] = chance
-
-        strategy = normalize(strategy)
+            strategy = [regret / total for regret in positive]
         # TODO: DCFR implementation
-        for action in actions:
-            self.weighted_strategy_sum[action] += strategy[action] * prob
         if prob > 0:
+            weighted_strategy_sum = self.weighted_strategy_sum
+            for i, chance in enumerate(strategy):
+                weighted_strategy_sum[i] += chance * prob
             self.t += 1
-        return strategy
+        return dict(zip(self.actions, strategy))
 
     def cumulative_strategy(self):
-        actions = self.infoset.legal_actions()
-        strategy = {}
-        if sum(self.weighted_strategy_sum.values()) == 0:
-            for action in actions:
-                strategy[action] = 1
-        else:
-            strategy = self.weighted_strategy_sum
-        strategy = normalize(strategy)
-        return strategy
+        total = sum(self.weighted_strategy_sum)
+        if total == 0:
+            return self.uniform_strategy()
+        return {action: weight / total
+                for action, weight in zip(self.actions, self.weighted_strategy_sum)}
 
     def add_regret(self, action, regret):
         # TODO: DCFR
-        self.regrets[action] += regret
+        self.regrets[self.actions.index(action)] += regret
 
     def __str__(self):
         return '{}\nStrategy: {}\nHits: {}'.format(self.infoset, self.cumulative_strategy(), self.t+1)